@@ -1,11 +1,41 @@
 import os
+import re
+import time
+import queue
+import atexit
+import asyncio
+import sqlite3
+import hashlib
 import logging
+import threading
+import logging.handlers
+import unicodedata
+from datetime import timedelta
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable
 
 # Third-party libraries
+import httpx
+import numpy as np
 from dotenv import load_dotenv
-from telegram import Update, constants
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
+from telegram import Bot, Message, Update, constants
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import Application, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
 from google import genai  # Required for the new Gemini SDK Client
+from google.genai import errors, types
+
+try:
+    import faiss  # Optional: speeds up similarity search once the semantic cache grows large
+except ImportError:
+    faiss = None
+
+try:
+    import uvloop  # Optional: faster drop-in event loop (not available on Windows)
+except ImportError:
+    uvloop = None
 
 # ==========================================
 # ENVIRONMENT VARIABLES & CONFIGURATION
@@ -17,17 +47,1260 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN_JawabAja_Bot")
 TELEGRAM_DEVELOPER_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-# Initialize the Gemini Generative AI Client with the provided API Key
-client = genai.Client(api_key=GOOGLE_API_KEY)
+# Throughput tuning: how many Gemini workers run in parallel, and how long (seconds)
+# a single message may wait in the queue plus the generation itself
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "16"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+# Starting (and maximum) Gemini request rate per second; lowered automatically on 429s
+GEMINI_MAX_RPS = float(os.getenv("GEMINI_MAX_RPS", "10"))
+
+# Webhook mode: when a public HTTPS domain is configured, Telegram pushes updates to
+# the bot instead of the bot long-polling for them
+WEBHOOK_DOMAIN = os.getenv("WEBHOOK_DOMAIN")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", "8443"))
+
+# SQLite file that keeps the response caches warm across restarts (empty disables it)
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "cache.db")
+
+# Initialize the Gemini Generative AI Client with the provided API Key.
+# SDK-level retries are disabled: a failing call should fail fast and free its worker,
+# while pacing after errors is handled by the adaptive rate limiter below.
+# Async calls multiplex over persistent HTTP/2 connections, sized for the worker pool
+# and embedding batcher driving many concurrent requests from this one process.
+client = genai.Client(
+    api_key=GOOGLE_API_KEY,
+    http_options=types.HttpOptions(
+        timeout=30_000,  # Milliseconds; a safety net per HTTP request (or stream read)
+        retry_options=types.HttpRetryOptions(attempts=1),
+        async_client_args={
+            "http2": True,
+            "limits": httpx.Limits(max_connections=200, max_keepalive_connections=50),
+        },
+    ),
+)
+
+GEMINI_MODEL = 'gemini-2.5-flash'
+
+# Static persona sent once through the Gemini context cache instead of on every message.
+# Only the per-message "Name: text" turn is billed as fresh input tokens.
+SYSTEM_INSTRUCTION = (
+    "You are a friendly and helpful AI assistant chatting with people on Telegram. "
+    "Every message you receive starts with the sender's first name, followed by a colon "
+    "and what they said (e.g. 'Alice: What is the capital of France?'). "
+    "Address the user by their name when it feels natural and answer their message directly."
+)
+
+# Generation settings built once at import and reused by every request, so the SDK
+# doesn't assemble and validate a fresh config object per message. Thinking is capped
+# so it can never eat the whole output budget and leave the visible answer empty.
+GENERATION_CONFIG = types.GenerateContentConfig(
+    system_instruction=SYSTEM_INSTRUCTION,
+    temperature=0.7,
+    max_output_tokens=2048,
+    thinking_config=types.ThinkingConfig(thinking_budget=1024),
+)
+
+# Per-message user turn, matching the format described in SYSTEM_INSTRUCTION
+PROMPT_TEMPLATE = "{name}: {message}"
+
+# HTTP status codes Gemini uses for exhausted quota and rejected credentials
+_QUOTA_ERROR_CODES = frozenset({429})
+_AUTH_ERROR_CODES = frozenset({401, 403})
+
+# Hot-path shortcuts resolved once at import time, so each message skips the
+# attribute chains through the telegram package and the Gemini client
+_TYPING = constants.ChatAction.TYPING
+_GEN_STREAM = client.aio.models.generate_content_stream
+_EMBED = client.aio.models.embed_content
+_DEV_CHAT = TELEGRAM_DEVELOPER_CHAT_ID
 
 # ==========================================
 # SYSTEM LOGGING SETUP
 # ==========================================
-# Configure basic logging to monitor bot activity, track routing, and capture errors in the terminal
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+# Configure logging to monitor bot activity, track routing, and capture errors in the terminal.
+# Records are handed to a queue and written to the terminal by a background thread, so
+# slow console I/O never stalls the event loop that serves every chat.
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_console_handler = logging.StreamHandler()
+_console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _console_handler)
+
+# The QueueHandler is attached directly rather than via basicConfig, which would give it
+# a default formatter and make every record get formatted twice
+_root_logger = logging.getLogger()
+_root_logger.setLevel(logging.INFO)
+_root_logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Flush pending records on exit
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# PERSISTENT CACHE STORE (SQLITE)
+# ==========================================
+# Both response caches are written through to a local SQLite file so a restart (deploy,
+# crash) doesn't send every returning prompt back to Gemini. All queries run in worker
+# threads via asyncio.to_thread, keeping disk I/O off the event loop.
+_IO_THREADS = 32                # Size of the default executor behind asyncio.to_thread
+_DB_PRUNE_EVERY = 500           # Inserts between two prunes of stale and surplus rows
+
+_db: sqlite3.Connection | None = None
+_db_lock = threading.Lock()  # One connection is shared by the to_thread workers
+_db_limits = (0, 0)          # (reply TTL, semantic entries kept), set by _db_open
+_db_inserts = 0
+
+def _db_prune(db: sqlite3.Connection) -> None:
+    """
+    Deletes expired replies of both caches, then all but the newest semantic entries.
+
+    Called with `_db_lock` held, at startup and every `_DB_PRUNE_EVERY` inserts, so the
+    file stays bounded on long-running deployments instead of only shrinking on restart.
+
+    Args:
+        db (sqlite3.Connection): The cache database.
+    """
+    ttl, semantic_max = _db_limits
+    cutoff = int(time.time()) - ttl
+    db.execute("DELETE FROM resp WHERE ts < ?", (cutoff,))
+    db.execute("DELETE FROM semantic WHERE ts < ?", (cutoff,))
+    db.execute(
+        "DELETE FROM semantic WHERE id NOT IN (SELECT id FROM semantic ORDER BY id DESC LIMIT ?)",
+        (semantic_max,),
+    )
+
+def _db_count_insert() -> None:
+    """Counts an insert (with `_db_lock` held) and prunes once enough have piled up."""
+    global _db_inserts
+
+    _db_inserts += 1
+    if _db_inserts >= _DB_PRUNE_EVERY:
+        _db_inserts = 0
+        _db_prune(_db)
+
+def _db_open(path: str, ttl: int, semantic_max: int) -> None:
+    """
+    Opens the cache database, creates its schema and prunes stale rows.
+
+    Args:
+        path (str): Location of the SQLite file.
+        ttl (int): Seconds after which exact-match and semantic replies expire.
+        semantic_max (int): Number of newest semantic entries to keep.
+    """
+    global _db, _db_limits
+
+    _db_limits = (ttl, semantic_max)
+    db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    try:
+        with _db_lock:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS resp (key TEXT PRIMARY KEY, reply TEXT NOT NULL, ts INTEGER NOT NULL)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS semantic ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, owner TEXT NOT NULL, vector BLOB NOT NULL, "
+                "reply TEXT NOT NULL, ts INTEGER NOT NULL)"
+            )
+            _db_prune(db)
+    except sqlite3.Error:
+        # Don't leak the handle (and its file lock) when the file is corrupt or read-only
+        db.close()
+        raise
+    _db = db
+
+def _db_get_reply(key: str, ttl: int) -> str | None:
+    with _db_lock:
+        row = _db.execute(
+            "SELECT reply FROM resp WHERE key = ? AND ts >= ?", (key, int(time.time()) - ttl)
+        ).fetchone()
+    return row[0] if row else None
+
+def _db_put_reply(key: str, reply: str) -> None:
+    with _db_lock:
+        _db.execute("INSERT OR REPLACE INTO resp (key, reply, ts) VALUES (?, ?, ?)", (key, reply, int(time.time())))
+        _db_count_insert()
+
+def _db_put_semantic(owner: str, vector: bytes, reply: str) -> None:
+    with _db_lock:
+        _db.execute(
+            "INSERT INTO semantic (owner, vector, reply, ts) VALUES (?, ?, ?, ?)",
+            (owner, vector, reply, int(time.time())),
+        )
+        _db_count_insert()
+
+def _db_load_semantic(ttl: int) -> list[tuple[str, bytes, str, int]]:
+    with _db_lock:
+        return _db.execute(
+            "SELECT owner, vector, reply, ts FROM semantic WHERE ts >= ? ORDER BY id", (int(time.time()) - ttl,)
+        ).fetchall()
+
+async def persistent_call(func: Callable[..., Any], *args: Any) -> Any:
+    """
+    Runs a cache database operation in a worker thread.
+
+    Persistence is an optimization: when the database is disabled or an operation
+    fails, the error is logged and None is returned so callers fall back to Gemini.
+
+    Args:
+        func (Callable[..., Any]): One of the `_db_*` helpers.
+        *args (Any): Arguments forwarded to `func`.
+
+    Returns:
+        Any: The helper's return value, or None if persistence is unavailable.
+    """
+    if _db is None:
+        return None
+    try:
+        return await asyncio.to_thread(func, *args)
+    except sqlite3.Error as e:
+        logger.warning("Cache database operation %s failed: %s", func.__name__, e)
+        return None
+
+# ==========================================
+# FAST PATH (TRIVIAL MESSAGES)
+# ==========================================
+# Some messages don't need an LLM at all: greetings, pings, emoji-only reactions and
+# walls of text beyond what the bot is willing to process. They get a canned reply
+# (written in MarkdownV2) before any cache lookup or Gemini call happens.
+MAX_MESSAGE_LENGTH = 4000       # Longer messages are refused without calling Gemini
+
+GREETINGS = frozenset({
+    "hi", "hii", "hello", "hey", "heya", "hiya", "yo", "hola", "halo", "hai",
+    "good morning", "good afternoon", "good evening",
+})
+PINGS = frozenset({"ping", "test", "are you there", "you there"})
+_EMOJI_ONLY_RE = re.compile(
+    r"[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF\u2190-\u21FF\u200D\uFE0F\s]+"
 )
+_TRAILING_PUNCTUATION = "!?.,~ "
+
+def fast_path_reply(user_name: str, user_text: str) -> str | None:
+    """
+    Returns a canned reply for messages that don't need Gemini.
+
+    Args:
+        user_name (str): The Telegram first name of the sender.
+        user_text (str): The raw message text sent by the user.
+
+    Returns:
+        str | None: A ready-to-send MarkdownV2 reply, or None if the message needs the LLM.
+    """
+    text = user_text.strip()
+    if not text:
+        return "🤔 I didn't catch that\\. Send me a question or a message to get started\\!"
+
+    if len(text) > MAX_MESSAGE_LENGTH:
+        return (
+            f"📏 *Message Too Long:* Please keep your message under {MAX_MESSAGE_LENGTH} characters "
+            "so I can answer it properly\\."
+        )
+
+    if _EMOJI_ONLY_RE.fullmatch(text):
+        return "😄 Nice\\! Send me a question whenever you're ready\\."
+
+    norm = normalize_prompt(text).rstrip(_TRAILING_PUNCTUATION)
+    if norm in GREETINGS:
+        return f"👋 Hi {escape_markdown_v2(user_name)}\\! How can I help you today?"
+    if norm in PINGS:
+        return "🏓 Pong\\! I'm online and ready to help\\."
+
+    return None
+
+# ==========================================
+# RESPONSE CACHE (L1 EXACT MATCH)
+# ==========================================
+# Identical prompts (e.g. "hi", "hello") are answered from memory instead of paying
+# for another Gemini round trip. Entries are kept in LRU order and expire after a TTL.
+# Memory misses fall back to the SQLite store, and hits found there are promoted.
+_CACHE_TTL = 3600       # Seconds before a cached reply is considered stale
+_CACHE_MAX = 10_000     # Maximum number of cached replies kept in memory
+
+_response_cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+_cache_lock = asyncio.Lock()
+
+def normalize_prompt(user_text: str) -> str:
+    """
+    Canonicalizes a user message before it is hashed or embedded.
+
+    Args:
+        user_text (str): The raw message text sent by the user.
+
+    Returns:
+        str: The NFC-normalized, stripped and lowercased text.
+    """
+    return unicodedata.normalize("NFC", user_text).strip().lower()
+
+def build_cache_key(model: str, user_name: str, user_text: str, history_digest: str = "") -> str:
+    """
+    Builds a deterministic cache key for a single prompt.
+
+    The user's text is NFC-normalized and lowercased so trivially different spellings
+    of the same message map to the same entry. The user's name is part of the key
+    because it is injected into the prompt (and often echoed back in the reply), and
+    the conversation digest is part of it because follow-up questions depend on context.
+
+    Args:
+        model (str): The Gemini model that produced the reply.
+        user_name (str): The Telegram first name of the sender.
+        user_text (str): The raw message text sent by the user.
+        history_digest (str): The digest of the prior conversation (empty for a fresh chat).
+
+    Returns:
+        str: The hex-encoded SHA-256 digest of the normalized prompt.
+    """
+    norm = normalize_prompt(user_text)
+    return hashlib.sha256(f"{model}|{user_name}|{history_digest}|{norm}".encode()).hexdigest()
+
+async def cache_get(key: str) -> str | None:
+    """
+    Looks up a cached reply and refreshes its LRU position on a hit.
+
+    The in-memory LRU is checked first; on a miss the persistent store is consulted
+    and any reply found there is promoted back into memory.
+
+    Args:
+        key (str): The key produced by `build_cache_key`.
+
+    Returns:
+        str | None: The cached reply text, or None on a miss or an expired entry.
+    """
+    async with _cache_lock:
+        entry = _response_cache.get(key)
+        if entry is not None:
+            stored_at, reply = entry
+            if time.monotonic() - stored_at <= _CACHE_TTL:
+                _response_cache.move_to_end(key)
+                return reply
+            # Stale entry: drop it so the next call refreshes it from Gemini
+            del _response_cache[key]
+
+    reply = await persistent_call(_db_get_reply, key, _CACHE_TTL)
+    if reply is not None:
+        await cache_put(key, reply, persist=False)
+    return reply
+
+async def cache_put(key: str, reply: str, persist: bool = True) -> None:
+    """
+    Stores a successful reply and evicts the least recently used entries when full.
+
+    Args:
+        key (str): The key produced by `build_cache_key`.
+        reply (str): The validated reply text returned by Gemini.
+        persist (bool): Whether to also write the reply through to the persistent store.
+    """
+    async with _cache_lock:
+        _response_cache[key] = (time.monotonic(), reply)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > _CACHE_MAX:
+            _response_cache.popitem(last=False)
+
+    if persist:
+        await persistent_call(_db_put_reply, key, reply)
+
+# ==========================================
+# SEMANTIC CACHE (L2 EMBEDDING SIMILARITY)
+# ==========================================
+# Most repeat traffic is paraphrased ("capital of france?" vs "what's the capital of France").
+# On an L1 miss the prompt is embedded and compared against previous prompts; a close
+# enough match reuses the stored reply and gets promoted into the L1 cache.
+_SEMANTIC_MODEL = 'text-embedding-004'
+_SEMANTIC_THRESHOLD = 0.92      # Minimum cosine similarity to reuse a reply
+_SEMANTIC_MAX = 10_000          # Maximum number of stored prompt embeddings
+_FAISS_MIN_ENTRIES = 1_000      # Switch from plain NumPy to a FAISS index past this size
+_EMBED_BATCH_MAX = 32           # Maximum prompts embedded in one request
+_EMBED_TIMEOUT = 5.0            # Seconds a message waits for its embedding before skipping L2
+
+# Rows are unit-length, so a plain dot product equals the cosine similarity
+_semantic_vectors: np.ndarray | None = None
+_semantic_owners: list[str] = []
+_semantic_replies: list[str] = []
+_semantic_times: list[float] = []  # Unix time each entry was stored, expired after _CACHE_TTL
+_faiss_index = None
+_semantic_lock = asyncio.Lock()
+
+# Prompts waiting to be embedded, coalesced into batched requests by `embedding_batcher`
+_embed_requests: "asyncio.Queue[tuple[str, asyncio.Future]]" = asyncio.Queue()
+_embedding_task: asyncio.Task | None = None
+
+async def embedding_batcher() -> None:
+    """
+    Background task that coalesces concurrent embedding requests into batched API calls.
+
+    It never waits for a batch to fill: each round takes whatever prompts are already
+    queued (up to `_EMBED_BATCH_MAX`), embeds them all in a single `embed_content` request
+    and scatters the vectors back to each waiting future. A lone prompt is embedded
+    immediately, while prompts that arrive during an in-flight request form the next
+    batch, so batching only kicks in under load and never adds latency.
+    """
+    while True:
+        batch = [await _embed_requests.get()]
+        while len(batch) < _EMBED_BATCH_MAX and not _embed_requests.empty():
+            batch.append(_embed_requests.get_nowait())
+
+        # Callers that already timed out don't need an embedding anymore
+        batch = [(text, future) for text, future in batch if not future.done()]
+        if not batch:
+            continue
+
+        try:
+            result = await _EMBED(
+                model=_SEMANTIC_MODEL,
+                contents=[text for text, _ in batch],
+            )
+            for (_, future), embedding in zip(batch, result.embeddings, strict=True):
+                if not future.done():
+                    future.set_result(embedding.values)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+async def embed_prompt(user_text: str) -> np.ndarray | None:
+    """
+    Embeds a user message for the semantic cache.
+
+    The request is handed to `embedding_batcher`, so concurrent messages share one
+    HTTP round trip. Failures and slow responses are logged and swallowed: the semantic
+    cache is an optimization and must never prevent the message from reaching Gemini.
+
+    Args:
+        user_text (str): The raw message text sent by the user.
+
+    Returns:
+        np.ndarray | None: A unit-length float32 vector, or None if embedding failed.
+    """
+    future = asyncio.get_running_loop().create_future()
+    _embed_requests.put_nowait((normalize_prompt(user_text), future))
+
+    try:
+        values = await asyncio.wait_for(future, timeout=_EMBED_TIMEOUT)
+        vector = np.asarray(values, dtype=np.float32)
+    except Exception as e:
+        logger.warning("Semantic cache embedding failed, skipping L2 lookup: %s", e)
+        return None
+
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else None
+
+def _search_semantic(query: np.ndarray) -> list[tuple[float, int]]:
+    """
+    Finds every stored prompt at least `_SEMANTIC_THRESHOLD` similar to the query.
+
+    Small caches are scanned with a single NumPy matrix-vector product. Past
+    `_FAISS_MIN_ENTRIES` rows an inner-product FAISS index (when installed) answers a
+    range query instead. Both return all rows above the threshold, regardless of owner,
+    so the caller's own entry is never crowded out by other users' copies of a popular
+    prompt. Must be called while holding `_semantic_lock`.
+
+    Args:
+        query (np.ndarray): The unit-length embedding returned by `embed_prompt`.
+
+    Returns:
+        list[tuple[float, int]]: (similarity, row) pairs, best match first.
+    """
+    global _faiss_index
+
+    if faiss is not None and len(_semantic_replies) >= _FAISS_MIN_ENTRIES:
+        if _faiss_index is None:
+            _faiss_index = faiss.IndexFlatIP(_semantic_vectors.shape[1])
+            _faiss_index.add(_semantic_vectors)
+        _, sims, rows = _faiss_index.range_search(query[np.newaxis, :], _SEMANTIC_THRESHOLD)
+    else:
+        sims = _semantic_vectors @ query
+        rows = np.nonzero(sims >= _SEMANTIC_THRESHOLD)[0]
+        sims = sims[rows]
+
+    # Only rows above the threshold can ever be reused, so sort just those
+    order = np.argsort(sims)[::-1]
+    return [(float(sims[i]), int(rows[i])) for i in order]
+
+async def semantic_get(user_name: str, query: np.ndarray) -> str | None:
+    """
+    Finds a stored reply whose prompt is a close paraphrase of the query.
+
+    Only entries created for the same user name are eligible, since replies are
+    personalized and often address the user directly. Entries older than `_CACHE_TTL`
+    are skipped, just like stale exact-match replies, so time-sensitive answers age out.
+
+    Args:
+        user_name (str): The Telegram first name of the sender.
+        query (np.ndarray): The unit-length embedding returned by `embed_prompt`.
+
+    Returns:
+        str | None: The reused reply text, or None if nothing is similar enough.
+    """
+    async with _semantic_lock:
+        if not _semantic_replies or _semantic_vectors.shape[1] != query.shape[0]:
+            return None
+
+        # Large scans run in a worker thread (NumPy and FAISS release the GIL while
+        # they crunch), so a big cache never stalls the event loop between updates
+        if len(_semantic_replies) >= _FAISS_MIN_ENTRIES:
+            candidates = await asyncio.to_thread(_search_semantic, query)
+        else:
+            candidates = _search_semantic(query)
+
+        oldest = time.time() - _CACHE_TTL
+        for similarity, row in candidates:
+            if similarity < _SEMANTIC_THRESHOLD:
+                break
+            if _semantic_owners[row] == user_name and _semantic_times[row] >= oldest:
+                return _semantic_replies[row]
+        return None
+
+async def semantic_put(user_name: str, vector: np.ndarray, reply: str) -> None:
+    """
+    Stores a prompt embedding together with its reply.
+
+    When the cache is full the oldest 10% of entries are dropped in one go, so the
+    FAISS index only has to be rebuilt occasionally rather than on every insert.
+
+    Args:
+        user_name (str): The Telegram first name of the sender.
+        vector (np.ndarray): The unit-length embedding returned by `embed_prompt`.
+        reply (str): The validated reply text returned by Gemini.
+    """
+    global _semantic_vectors, _semantic_owners, _semantic_replies, _semantic_times, _faiss_index
+
+    await persistent_call(_db_put_semantic, user_name, vector.astype(np.float32).tobytes(), reply)
+
+    async with _semantic_lock:
+        row = vector[np.newaxis, :]
+        if _semantic_vectors is None or _semantic_vectors.shape[1] != vector.shape[0]:
+            _semantic_vectors, _semantic_owners, _semantic_replies, _semantic_times = row, [], [], []
+            _faiss_index = None
+        else:
+            _semantic_vectors = np.vstack([_semantic_vectors, row])
+            if _faiss_index is not None:
+                _faiss_index.add(row)
+
+        _semantic_owners.append(user_name)
+        _semantic_replies.append(reply)
+        _semantic_times.append(time.time())
+
+        if len(_semantic_replies) > _SEMANTIC_MAX:
+            drop = _SEMANTIC_MAX // 10
+            _semantic_vectors = _semantic_vectors[drop:]
+            _semantic_owners = _semantic_owners[drop:]
+            _semantic_replies = _semantic_replies[drop:]
+            _semantic_times = _semantic_times[drop:]
+            _faiss_index = None  # Rebuilt lazily on the next large search
+
+async def semantic_load() -> None:
+    """
+    Warms the semantic cache from the persistent store at startup.
+
+    Rows are stacked into the matrix in one go rather than through `semantic_put`,
+    which would copy the growing matrix once per row. Expired rows are never loaded, and
+    rows whose dimension differs from the newest one (e.g. after an embedding model
+    change) are skipped.
+    """
+    global _semantic_vectors, _semantic_owners, _semantic_replies, _semantic_times, _faiss_index
+
+    rows = await persistent_call(_db_load_semantic, _CACHE_TTL)
+    if not rows:
+        return
+
+    vectors = [np.frombuffer(blob, dtype=np.float32) for _, blob, _, _ in rows]
+    dim = vectors[-1].shape[0]
+    keep = [i for i, vector in enumerate(vectors) if vector.shape[0] == dim][-_SEMANTIC_MAX:]
+
+    async with _semantic_lock:
+        _semantic_vectors = np.vstack([vectors[i] for i in keep])
+        _semantic_owners = [rows[i][0] for i in keep]
+        _semantic_replies = [rows[i][2] for i in keep]
+        _semantic_times = [float(rows[i][3]) for i in keep]
+        _faiss_index = None
+
+    logger.info("Semantic cache warmed with %s entries from %s", len(keep), CACHE_DB_PATH)
+
+# ==========================================
+# GEMINI CONTEXT CACHE (STATIC SYSTEM PREAMBLE)
+# ==========================================
+# The system instruction is uploaded once as a cached content object and referenced by
+# name. Gemini only caches content above a minimum token count, so the instruction is
+# measured once at startup; when it is too small (or creation is rejected) the bot
+# sends it inline instead and never retries.
+_CONTEXT_CACHE_TTL = 3600                       # Seconds the cached preamble stays alive
+_CONTEXT_CACHE_REFRESH = _CONTEXT_CACHE_TTL // 2  # Extend the TTL well before it lapses
+_CONTEXT_CACHE_MIN_TOKENS = 1024                # Gemini 2.5 Flash's minimum cacheable size
+
+_context_cache_name: str | None = None
+_generation_config = GENERATION_CONFIG
+_context_cache_task: asyncio.Task | None = None
+
+async def context_cache_supported() -> bool:
+    """
+    Checks once whether the system instruction is large enough to be cached at all.
+
+    Returns:
+        bool: True if the instruction meets `_CONTEXT_CACHE_MIN_TOKENS`.
+    """
+    try:
+        result = await client.aio.models.count_tokens(model=GEMINI_MODEL, contents=SYSTEM_INSTRUCTION)
+    except Exception as e:
+        logger.warning("Could not measure the system instruction, sending it inline: %s", e)
+        return False
+
+    if (result.total_tokens or 0) < _CONTEXT_CACHE_MIN_TOKENS:
+        logger.info(
+            "System instruction is %s tokens (< %s), sending it inline instead of caching it",
+            result.total_tokens, _CONTEXT_CACHE_MIN_TOKENS,
+        )
+        return False
+    return True
+
+async def create_context_cache() -> bool:
+    """
+    Uploads the system instruction into a Gemini context cache.
+
+    On success every subsequent `generate_content` call references the cache by name.
+    On failure the inline `system_instruction` config stays in place, so the bot keeps
+    working exactly as before, just without the token savings.
+
+    Returns:
+        bool: True if the cache was created.
+    """
+    global _context_cache_name, _generation_config
+
+    try:
+        cache = await client.aio.caches.create(
+            model=GEMINI_MODEL,
+            config=types.CreateCachedContentConfig(
+                system_instruction=SYSTEM_INSTRUCTION,
+                ttl=f"{_CONTEXT_CACHE_TTL}s",
+            ),
+        )
+    except Exception as e:
+        logger.warning("Gemini context cache unavailable, sending the system instruction inline: %s", e)
+        _context_cache_name = None
+        _generation_config = GENERATION_CONFIG
+        return False
+
+    _context_cache_name = cache.name
+    # Same prebuilt settings, with the instruction now coming from the cache instead
+    _generation_config = GENERATION_CONFIG.model_copy(
+        update={"system_instruction": None, "cached_content": cache.name}
+    )
+    logger.info("Gemini context cache ready: %s", cache.name)
+    return True
+
+async def refresh_context_cache() -> None:
+    """
+    Background task that keeps the context cache alive for as long as the bot runs.
+
+    Periodically extends the cache TTL. If the cache has vanished, it is recreated
+    once; if that fails too, the task stops and the bot stays on the inline instruction.
+    """
+    while True:
+        await asyncio.sleep(_CONTEXT_CACHE_REFRESH)
+
+        try:
+            await client.aio.caches.update(
+                name=_context_cache_name,
+                config=types.UpdateCachedContentConfig(ttl=f"{_CONTEXT_CACHE_TTL}s"),
+            )
+        except Exception as e:
+            logger.warning("Failed to extend Gemini context cache, recreating it: %s", e)
+            if not await create_context_cache():
+                return
+
+# ==========================================
+# ADAPTIVE RATE LIMITING
+# ==========================================
+# Gemini calls are paced by a token bucket whose rate follows AIMD: it halves when the
+# API answers 429 (once per burst) and creeps back up with every success. Separately, an
+# EMA of the time-to-first-token sets how long a call may stay silent before it is abandoned.
+_FIRST_TOKEN_EMA_ALPHA = 0.2    # Weight of the newest sample in the latency average
+_FIRST_TOKEN_GRACE = 5.0        # Seconds added on top of 1.5x the average latency
+
+class AdaptiveRateLimiter:
+    """
+    Async token-bucket limiter with additive-increase / multiplicative-decrease pacing.
+
+    Used as `async with limiter:` around a request; callers report the outcome with
+    `succeeded()` or `throttled()` so the rate converges on what the API accepts.
+    Requests already in flight when the limit is hit all fail together, so the rate is
+    halved at most once per `cooldown` window: one congestion event, one decrease.
+
+    Args:
+        max_rate (float): Upper bound (and starting value) in requests per second.
+        min_rate (float): Lower bound in requests per second.
+        cooldown (float): Seconds after a decrease during which further 429s are ignored.
+    """
+
+    def __init__(self, max_rate: float, min_rate: float = 0.2, cooldown: float = 5.0) -> None:
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.cooldown = cooldown
+        self.rate = max_rate
+        self._tokens = max_rate
+        self._updated = time.monotonic()
+        self._last_decrease = float("-inf")
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self) -> "AdaptiveRateLimiter":
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return self
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        return None
+
+    def succeeded(self) -> None:
+        """Additively raises the rate after a successful request."""
+        self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def throttled(self) -> None:
+        """Halves the rate after the API reported a rate or quota limit."""
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._tokens = min(self._tokens, self.rate)
+        logger.warning("Gemini throttled the bot, slowing down to %.2f requests/s", self.rate)
+
+_gemini_limiter = AdaptiveRateLimiter(GEMINI_MAX_RPS)
+_first_token_ema: float | None = None
+
+def first_token_timeout() -> float:
+    """
+    Returns how long a Gemini call may take to produce its first chunk.
+
+    Returns:
+        float: 1.5x the observed average plus a grace period, capped at `GEMINI_TIMEOUT`.
+    """
+    if _first_token_ema is None:
+        return GEMINI_TIMEOUT
+    return min(GEMINI_TIMEOUT, 1.5 * _first_token_ema + _FIRST_TOKEN_GRACE)
+
+def record_first_token_latency(seconds: float) -> None:
+    """
+    Folds a new time-to-first-token sample into the moving average.
+
+    Calls abandoned by `first_token_timeout()` report the cutoff itself, so a run of
+    slower (e.g. thinking-heavy) replies pushes the cutoff up instead of failing forever.
+
+    Args:
+        seconds (float): Time from sending the request to receiving the first chunk,
+            or the timeout that expired before it arrived.
+    """
+    global _first_token_ema
+    if _first_token_ema is None:
+        _first_token_ema = seconds
+    else:
+        _first_token_ema += _FIRST_TOKEN_EMA_ALPHA * (seconds - _first_token_ema)
+
+# ==========================================
+# GEMINI WORKER POOL (PRODUCER / CONSUMER)
+# ==========================================
+# Handlers never call Gemini directly: they enqueue a job and await its future, while a
+# fixed pool of workers drains the queue. This is the single throttling point for the
+# API, so traffic spikes queue up here instead of tripping the 429/quota limits.
+_GEMINI_QUEUE_MAX = 1_000       # Pending jobs before producers start waiting for room
+
+_gemini_jobs: "asyncio.Queue[tuple[Callable[[], Awaitable[Any]], asyncio.Future]]" = asyncio.Queue(maxsize=_GEMINI_QUEUE_MAX)
+_gemini_workers: list[asyncio.Task] = []
+
+async def gemini_worker() -> None:
+    """
+    Consumer coroutine that runs queued Gemini jobs one at a time, forever.
+
+    Jobs whose caller already gave up (cancelled future) are skipped, and a running job
+    is cancelled the moment its caller gives up, so it can't keep streaming into a chat
+    that has already been told the request failed. Every job is also bounded by
+    `GEMINI_TIMEOUT` so a hung request cannot occupy a worker indefinitely. Each job is
+    paced by the shared adaptive rate limiter, which it feeds back into.
+    """
+    while True:
+        job, future = await _gemini_jobs.get()
+        running = None
+        try:
+            if future.cancelled():
+                continue
+            async with _gemini_limiter:
+                # The caller may have given up while the limiter was pacing us
+                if future.cancelled():
+                    continue
+                running = asyncio.ensure_future(asyncio.wait_for(job(), timeout=GEMINI_TIMEOUT))
+                future.add_done_callback(lambda f, task=running: task.cancel() if f.cancelled() else None)
+                await asyncio.wait({running})
+
+            if running.cancelled():
+                continue
+            result = running.result()
+            _gemini_limiter.succeeded()
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if isinstance(e, errors.ClientError) and e.code in _QUOTA_ERROR_CODES:
+                _gemini_limiter.throttled()
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            # Only reachable with a live job when the worker itself is being cancelled
+            if running is not None and not running.done():
+                running.cancel()
+            _gemini_jobs.task_done()
+
+async def submit_gemini_job(job: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Enqueues a Gemini call for the worker pool and waits for its result.
+
+    Args:
+        job (Callable[[], Awaitable[Any]]): A zero-argument coroutine function performing the call.
+
+    Returns:
+        Any: Whatever the job returned. Exceptions raised by the job are re-raised here.
+    """
+    future = asyncio.get_running_loop().create_future()
+    await _gemini_jobs.put((job, future))
+    return await future
+
+# ==========================================
+# SINGLE-FLIGHT DEDUPLICATION
+# ==========================================
+# When identical prompts arrive while the first one is still being generated, only the
+# first ("leader") calls Gemini; the others await its result instead of paying for a
+# duplicate request. Keys are the L1 cache keys, so only true duplicates are merged.
+_inflight: dict[str, asyncio.Future] = {}
+
+async def single_flight(key: str, job: Callable[[], Awaitable[str]]) -> tuple[str, bool]:
+    """
+    Runs a generation job at most once per key among concurrent callers.
+
+    The dictionary is only touched between awaits, so the single-threaded event loop
+    already makes the lookup-and-insert atomic; no extra lock is needed.
+
+    The key is the L1 cache key, which includes the user's name and a digest of the
+    conversation so far. In practice only opening questions from same-named users in
+    different chats are merged (e.g. two "Alex"es asking the same thing at once). Messages
+    within one chat never are: the per-chat lock serializes them and each turn changes the
+    history digest. The same question from differently named users still triggers one
+    request per user, since each reply is personalized.
+
+    Args:
+        key (str): The cache key identifying the prompt.
+        job (Callable[[], Awaitable[str]]): Coroutine function producing the generated text.
+            Only the leader's job runs (and streams into the leader's chat); followers
+            receive the finished text and send it as a regular message.
+
+    Returns:
+        tuple[str, bool]: The generated text, and whether this caller was the leader
+        (only the leader should cache it, so a merged generation is stored once).
+    """
+    flight = _inflight.get(key)
+    if flight is not None:
+        # Shielded so a cancelled follower can't cancel the leader's shared result
+        return await asyncio.shield(flight), False
+
+    flight = _inflight[key] = asyncio.get_running_loop().create_future()
+    try:
+        generated_text = await job()
+    except asyncio.CancelledError:
+        flight.cancel()
+        raise
+    except Exception as e:
+        flight.set_exception(e)
+        flight.exception()  # Mark as retrieved: having followers is optional
+        raise
+    else:
+        flight.set_result(generated_text)
+        return generated_text, True
+    finally:
+        del _inflight[key]
+
+# ==========================================
+# TELEGRAM MARKDOWNV2 FORMATTING
+# ==========================================
+# Replies are sent with MarkdownV2. Dynamic text (LLM output, exception messages) is
+# escaped with precomputed translation tables, a single C-level pass per message, so
+# Telegram can never reject a send because of stray formatting characters.
+_MDV2_SPECIALS = frozenset("\\_*[]()~`>#+-=|{}.!")
+_MDV2 = str.maketrans({c: "\\" + c for c in _MDV2_SPECIALS})
+_MDV2_CODE = str.maketrans({c: "\\" + c for c in "\\`"})  # Inside `code` only these are special
+
+def escape_markdown_v2(text: str) -> str:
+    """
+    Escapes arbitrary text so it renders literally under MarkdownV2.
+
+    Args:
+        text (str): Untrusted text, e.g. a Gemini reply.
+
+    Returns:
+        str: The text with every MarkdownV2 special character backslash-escaped.
+    """
+    return text.translate(_MDV2)
+
+def split_markdown_v2(text: str, limit: int = 4096) -> list[str]:
+    """
+    Escapes text for MarkdownV2 and splits it into messages that fit Telegram's limit.
+
+    The split is made on the raw text (preferring line breaks) while counting each
+    special character as two, so no piece exceeds `limit` once escaped and no escape
+    sequence is ever cut in half.
+
+    Args:
+        text (str): Untrusted text, e.g. a Gemini reply.
+        limit (int): Maximum length of a single escaped message.
+
+    Returns:
+        list[str]: One or more escaped, non-empty MarkdownV2 messages.
+    """
+    pieces = []
+    start = 0
+    while start < len(text):
+        end, cost, last_newline = start, 0, -1
+        while end < len(text):
+            step = 2 if text[end] in _MDV2_SPECIALS else 1
+            if cost + step > limit:
+                break
+            cost += step
+            if text[end] == "\n":
+                last_newline = end
+            end += 1
+
+        # Prefer ending a piece on a line break rather than mid-sentence
+        if end < len(text) and last_newline > start:
+            end = last_newline + 1
+
+        if text[start:end].strip():
+            pieces.append(escape_markdown_v2(text[start:end]))
+        start = end
+
+    return pieces or [escape_markdown_v2(text)]
+
+# ==========================================
+# STREAMING DELIVERY
+# ==========================================
+# Replies are streamed into Telegram as Gemini produces them: the first chunk is sent
+# as a new message which is then edited in place, so users see text after the first
+# token instead of waiting for the whole answer.
+_STREAM_EDIT_INTERVAL = 1.0     # Seconds between edits (Telegram allows ~1 edit/s per chat)
+_TELEGRAM_MAX_CHARS = 4096      # Telegram's hard limit on a single message's length
+_FLOOD_RETRIES = 3              # Attempts at a final send/edit that hits Telegram's flood control
+
+class StreamedReply:
+    """
+    Progress of a reply being streamed into Telegram.
+
+    Shared between `handle_message` and `stream_reply`, so the handler still knows which
+    message holds the partial preview when the stream fails or times out midway, and
+    whether Gemini finished the reply or stopped early.
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.message: Message | None = None
+        self.last_edit = 0.0  # time.monotonic() of the last preview send or edit
+        self.finish_reason: types.FinishReason | None = None
+
+    @property
+    def complete(self) -> bool:
+        """Whether Gemini ended the reply naturally (not cut off by a token limit or filter)."""
+        return self.finish_reason == types.FinishReason.STOP
+
+async def stream_reply(bot: Bot, chat_id: int, contents: list[types.Content], progress: StreamedReply) -> str:
+    """
+    Streams a Gemini generation into a Telegram message, editing it as chunks arrive.
+
+    Intermediate edits are sent as plain text (partial output is often unbalanced),
+    debounced to respect Telegram's per-chat rate limit. Formatting is applied once
+    the full reply is known, by `deliver_reply`. A call that stays silent for longer
+    than `first_token_timeout()` is abandoned with a TimeoutError. A reply Gemini cut
+    short (e.g. at `max_output_tokens` or by a safety stop) gets a visible note appended.
+
+    Args:
+        bot (telegram.Bot): The bot used to send and edit the message.
+        chat_id (int): The unique ID of the target chat.
+        contents (list[types.Content]): The multi-turn payload for Gemini.
+        progress (StreamedReply): Updated with the text so far and the preview message.
+
+    Returns:
+        str: The full generated text.
+    """
+    shown_text = ""
+
+    async def open_stream():
+        stream = await _GEN_STREAM(
+            model=GEMINI_MODEL,
+            contents=contents,
+            config=_generation_config,
+        )
+        chunks = aiter(stream)
+        return chunks, await anext(chunks, None)
+
+    async def all_chunks():
+        if first_chunk is not None:
+            yield first_chunk
+            async for chunk in chunks:
+                yield chunk
+
+    started = time.monotonic()
+    timeout = first_token_timeout()
+    try:
+        chunks, first_chunk = await asyncio.wait_for(open_stream(), timeout=timeout)
+    except asyncio.TimeoutError:
+        # The true latency is unknown but at least the cutoff; learn from it all the same
+        record_first_token_latency(timeout)
+        raise
+    record_first_token_latency(time.monotonic() - started)
+
+    async for chunk in all_chunks():
+        if chunk.candidates and chunk.candidates[0].finish_reason:
+            progress.finish_reason = chunk.candidates[0].finish_reason
+        if not chunk.text:
+            continue
+        progress.text += chunk.text
+
+        preview = progress.text[:_TELEGRAM_MAX_CHARS]
+        if not preview.strip():
+            continue
+
+        now = time.monotonic()
+        if progress.message is None:
+            progress.message = await bot.send_message(chat_id=chat_id, text=preview)
+        elif now - progress.last_edit >= _STREAM_EDIT_INTERVAL and preview != shown_text:
+            try:
+                await bot.edit_message_text(chat_id=chat_id, message_id=progress.message.message_id, text=preview)
+            except TelegramError as e:
+                # A dropped intermediate edit is harmless: the final edit carries the full text
+                logger.debug("Skipped streaming edit in chat %s: %s", chat_id, e)
+        else:
+            continue
+        shown_text, progress.last_edit = preview, now
+
+    # Never present a truncated answer as if it were complete
+    if progress.text.strip() and not progress.complete:
+        reason = getattr(progress.finish_reason, "name", "NO_FINISH_REASON")
+        progress.text += f"\n\n⚠️ This reply was cut short ({reason})."
+
+    return progress.text
+
+async def retry_flood_control(call: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Runs a Bot API call, waiting out Telegram's flood control (RetryAfter) if it hits it.
+
+    Args:
+        call (Callable[[], Awaitable[Any]]): Coroutine function performing the API call.
+
+    Returns:
+        Any: Whatever the API call returned.
+    """
+    for attempt in range(_FLOOD_RETRIES):
+        try:
+            return await call()
+        except RetryAfter as e:
+            if attempt == _FLOOD_RETRIES - 1:
+                raise
+            delay = e.retry_after
+            if isinstance(delay, timedelta):
+                delay = delay.total_seconds()
+            logger.warning("Telegram flood control hit, retrying in %s seconds", delay)
+            await asyncio.sleep(delay)
+
+async def deliver_reply(bot: Bot, chat_id: int, pieces: list[str], streamed: StreamedReply | None = None) -> None:
+    """
+    Sends the final reply, or finalizes the message it was streamed into.
+
+    The first piece replaces the streamed preview (when there is one); any further
+    pieces of an over-long reply follow as separate messages. The final edit keeps the
+    same pacing as the preview edits, and flood-control responses are waited out, so
+    the formatted reply doesn't get lost behind a plain-text preview.
+
+    Args:
+        bot (telegram.Bot): The bot used to send or edit the messages.
+        chat_id (int): The unique ID of the target chat.
+        pieces (list[str]): The final text, already valid MarkdownV2 and split to fit
+            Telegram's message length limit.
+        streamed (StreamedReply | None): The streamed reply to finalize, if any.
+    """
+    first, *rest = pieces
+    message = streamed.message if streamed is not None else None
+
+    if message is None:
+        await retry_flood_control(partial(
+            bot.send_message,
+            chat_id=chat_id, 
+            text=first, 
+            parse_mode="MarkdownV2"
+        ))
+    else:
+        # Give Telegram the same breathing room as between the streamed preview edits
+        wait = _STREAM_EDIT_INTERVAL - (time.monotonic() - streamed.last_edit)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        try:
+            await retry_flood_control(partial(
+                bot.edit_message_text,
+                chat_id=chat_id,
+                message_id=message.message_id,
+                text=first,
+                parse_mode="MarkdownV2"
+            ))
+        except BadRequest as e:
+            # The last streamed preview may already match the final text exactly
+            if "not modified" not in e.message:
+                raise
+
+    for piece in rest:
+        await retry_flood_control(partial(bot.send_message, chat_id=chat_id, text=piece, parse_mode="MarkdownV2"))
+
+# ==========================================
+# CONVERSATION HISTORY (PER-CHAT MEMORY)
+# ==========================================
+# Each chat keeps a short rolling window of recent turns that is sent to Gemini as
+# multi-turn contents, so follow-up questions keep their context. A chat that goes
+# quiet starts a fresh conversation, which makes its next message an opening message
+# again (eligible for the response caches). Chats are also kept in LRU order.
+_HISTORY_TURNS = 12             # Messages (user + model) remembered per chat
+_HISTORY_CHAR_BUDGET = 16_000   # Roughly 4k tokens; oldest turns are dropped beyond this
+_HISTORY_MAX_CHATS = 1_000      # Conversations kept in memory at once
+_HISTORY_IDLE_TIMEOUT = 30 * 60 # Seconds of silence after which a conversation is reset
+_CHAT_MAX_PENDING = 4           # Turns running or queued per chat; further messages are turned away
+
+_histories: "OrderedDict[int, deque[types.Content]]" = OrderedDict()
+_history_last_seen: dict[int, float] = {}
+_chat_locks: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+_chat_pending: defaultdict[int, int] = defaultdict(int)
+_chat_busy_notified: set[int] = set()
+
+def get_history(chat_id: int) -> deque[types.Content]:
+    """
+    Returns the rolling history of a chat, creating it on first use.
+
+    A chat idle for longer than `_HISTORY_IDLE_TIMEOUT` gets an empty history. Touching
+    a chat moves it to the most recently used position; the least recently used chats
+    (and their idle locks) are evicted once `_HISTORY_MAX_CHATS` is exceeded.
+
+    Args:
+        chat_id (int): The unique ID of the Telegram chat.
+
+    Returns:
+        deque[types.Content]: The chat's recent turns, oldest first.
+    """
+    now = time.monotonic()
+    history = _histories.get(chat_id)
+    if history is None:
+        history = _histories[chat_id] = deque(maxlen=_HISTORY_TURNS)
+    elif now - _history_last_seen.get(chat_id, now) > _HISTORY_IDLE_TIMEOUT:
+        history.clear()
+    _histories.move_to_end(chat_id)
+    _history_last_seen[chat_id] = now
+
+    while len(_histories) > _HISTORY_MAX_CHATS:
+        evicted_id, _ = _histories.popitem(last=False)
+        _history_last_seen.pop(evicted_id, None)
+        lock = _chat_locks.get(evicted_id)
+        if lock is not None and evicted_id not in _chat_pending:
+            del _chat_locks[evicted_id]
+
+    return history
+
+def chat_is_busy(chat_id: int) -> bool:
+    """
+    Checks whether a chat already has `_CHAT_MAX_PENDING` turns running or queued.
+
+    Every queued turn holds one of PTB's concurrent-update slots while it waits for the
+    chat's lock, so an unbounded backlog in one flooded chat (e.g. a batch of forwarded
+    messages) would stall every other chat behind it.
+
+    Args:
+        chat_id (int): The unique ID of the chat.
+
+    Returns:
+        bool: True if the new message should be turned away.
+    """
+    return _chat_pending[chat_id] >= _CHAT_MAX_PENDING
+
+@asynccontextmanager
+async def chat_turn(chat_id: int) -> AsyncIterator[None]:
+    """
+    Counts a turn as pending for its chat and serializes it behind the chat's lock.
+
+    Serializing turns within one chat keeps concurrent messages from interleaving its
+    history. Callers check `chat_is_busy` first, with no await in between.
+
+    Args:
+        chat_id (int): The unique ID of the chat.
+    """
+    _chat_pending[chat_id] += 1
+    try:
+        async with _chat_locks[chat_id]:
+            yield
+    finally:
+        _chat_pending[chat_id] -= 1
+        if not _chat_pending[chat_id]:
+            del _chat_pending[chat_id]
+            _chat_busy_notified.discard(chat_id)
+
+def build_contents(history: deque[types.Content], prompt: str) -> list[types.Content]:
+    """
+    Assembles the multi-turn payload for Gemini from the chat history and the new prompt.
+
+    Turn sizes are estimated locally from their character count (about 4 characters
+    per token) rather than with `count_tokens`, which would cost an extra round trip
+    per message. The oldest turns are dropped until the payload fits the budget.
+
+    Args:
+        history (deque[types.Content]): The chat's recent turns, oldest first.
+        prompt (str): The new user turn.
+
+    Returns:
+        list[types.Content]: The turns to send, always starting with a user turn.
+    """
+    turns = list(history)
+    turns.append(types.Content(role="user", parts=[types.Part(text=prompt)]))
+
+    total_chars = sum(len(turn.parts[0].text) for turn in turns)
+    while len(turns) > 1 and (total_chars > _HISTORY_CHAR_BUDGET or turns[0].role != "user"):
+        total_chars -= len(turns.pop(0).parts[0].text)
+
+    return turns
+
+def digest_history(history: deque[types.Content]) -> str:
+    """
+    Fingerprints the prior conversation so cached replies are only reused in the same context.
+
+    Args:
+        history (deque[types.Content]): The chat's recent turns, oldest first.
+
+    Returns:
+        str: A hex SHA-256 digest, or an empty string for a fresh conversation.
+    """
+    if not history:
+        return ""
+    transcript = "\n".join(f"{turn.role}:{turn.parts[0].text}" for turn in history)
+    return hashlib.sha256(transcript.encode()).hexdigest()
+
+# ==========================================
+# ERROR CLASSIFICATION
+# ==========================================
+def is_invalid_api_key(error: errors.ClientError) -> bool:
+    """
+    Checks whether a Gemini client error was caused by a bad or expired API key.
+
+    Gemini reports unknown keys as a plain 400 INVALID_ARGUMENT, so the structured
+    `reason` in the error details is inspected instead of the human-readable message.
+
+    Args:
+        error (google.genai.errors.ClientError): The 4xx error raised by the SDK.
+
+    Returns:
+        bool: True if the API key was rejected.
+    """
+    if error.code in _AUTH_ERROR_CODES:
+        return True
+
+    details = error.details.get("error", {}).get("details", []) if isinstance(error.details, dict) else []
+    return any(isinstance(item, dict) and item.get("reason") == "API_KEY_INVALID" for item in details)
 
 # ==========================================
 # BOT COMMAND HANDLERS
@@ -50,16 +1323,16 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     
     # Construct the welcoming interface text
     welcome_text = (
-        "🤖 **Hello! I am your AI Assistant.**\n\n"
-        "I am powered by Google Gemini and ready to help. "
-        "Send me a message to start chatting, brainstorm ideas, or ask any questions!"
+        "🤖 *Hello\\! I am your AI Assistant\\.*\n\n"
+        "I am powered by Google Gemini and ready to help\\. "
+        "Send me a message to start chatting, brainstorm ideas, or ask any questions\\!"
     )
 
     # Transmit the message back to the user's Telegram client asynchronously
     await context.bot.send_message(
         chat_id=chat_id, 
         text=welcome_text,
-        parse_mode='Markdown' # Enables bold text and basic formatting
+        parse_mode='MarkdownV2' # Enables bold text and basic formatting
     )
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -81,53 +1354,130 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name
     
+    # 2. Answer trivial messages (greetings, emoji, oversized text) without any API call
+    canned_reply = fast_path_reply(user_name, user_text)
+    if canned_reply is not None:
+        await deliver_reply(context.bot, chat_id, [canned_reply])
+        return
+
     # Initialize an empty string to store the final response
     reply_text = ""
+    # Tracks whether reply_text is a real answer (as opposed to a fallback or error notice)
+    answered = False
+    # Tracks whether this handler generated that answer itself (and so must cache it)
+    generated = False
+    # The streamed text and preview message, finalized (or overwritten by an error notice) in the last step
+    progress = StreamedReply()
 
-    try:
-        # 2. Inject the user's name into the prompt so the AI feels more personal
-        # We tell the AI who is speaking before giving it the actual message
-        contextual_prompt = f"The user you are talking to is named {user_name}. They said: '{user_text}'"
+    # Turn away messages once the chat's backlog is full, so one flooded chat can't hold
+    # every concurrent-update slot; the user is told once per backlog, not per message
+    if chat_is_busy(chat_id):
+        logger.info("Chat %s already has %s pending turns, dropping a message", chat_id, _CHAT_MAX_PENDING)
+        if chat_id not in _chat_busy_notified:
+            _chat_busy_notified.add(chat_id)
+            await deliver_reply(
+                context.bot,
+                chat_id,
+                ["⏳ *Busy:* I'm still answering your earlier messages\\. Please wait for those replies before sending more\\."],
+            )
+        return
 
-        # 3. Trigger the 'Typing...' action indicator in the Telegram UI
-        await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
+    # Serialize turns within one chat so concurrent messages can't interleave its history
+    async with chat_turn(chat_id):
+        history = get_history(chat_id)
 
-        # 4. Invoke the Google Gemini Generative AI Model with the contextual prompt
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=contextual_prompt,
-        )
+        # 3. Serve repeated prompts straight from the L1 exact-match cache (no API call)
+        cache_key = build_cache_key(GEMINI_MODEL, user_name, user_text, digest_history(history))
+        cached_reply = await cache_get(cache_key)
 
-        # 5. Validate the LLM output safely
-        if response.text and len(response.text.strip()) > 0:
-            reply_text = response.text
-        else:
-            # Graceful fallback if the AI's mind goes blank
-            reply_text = "I'm sorry, my AI engine couldn't process that. Could you try rephrasing?"
-            
-    except Exception as e: 
-        # 6. Handle API failures securely and categorize the error
-        error_msg = str(e).lower()
-        logging.error(f"Failed to generate AI response for User {user_id} ({user_name}): {e}")
-        
-        # Check if the error is due to API quota limits or rate limiting
-        if "quota" in error_msg or "429" in error_msg or "exhausted" in error_msg:
-            reply_text = "⚠️ **API Limit Reached:** My AI engine is receiving too many requests right now or has reached its daily capacity. Please try again later or tomorrow!"
-            
-        # Check if the error is due to an invalid or missing API key
-        elif "api_key" in error_msg or "key invalid" in error_msg:
-            reply_text = "🛑 **Configuration Error:** My API key seems to be invalid or expired. Please report this to the Developer!"
-        
-        # Fallback for any other unexpected system errors (e.g., server down)
+        # 4. On an L1 miss, reuse the reply of a close paraphrase from the L2 semantic cache
+        # Only opening messages qualify: follow-ups only make sense within their own conversation
+        query_vector = None
+        if cached_reply is None and not history:
+            query_vector = await embed_prompt(user_text)
+            if query_vector is not None:
+                cached_reply = await semantic_get(user_name, query_vector)
+                if cached_reply is not None:
+                    # Promote the paraphrase hit so the exact same prompt skips embedding next time
+                    await cache_put(cache_key, cached_reply)
+
+        # 5. Prefix the message with the user's name so the AI feels more personal
+        # The instructions explaining this format live in the cached system preamble
+        contextual_prompt = PROMPT_TEMPLATE.format(name=user_name, message=user_text)
+
+        if cached_reply is not None:
+            reply_text = cached_reply
+            answered = True
         else:
-            reply_text = "⚠️ **System Error:** My AI engine is currently unreachable or busy. Please try again in a moment!"
+            try:
+                # 6. Trigger the 'Typing...' action indicator in the Telegram UI
+                await context.bot.send_chat_action(chat_id=chat_id, action=_TYPING)
 
-    # 7. Transmit the final formulated text back to the user asynchronously
-    await context.bot.send_message(
-        chat_id=chat_id, 
-        text=reply_text, 
-        parse_mode="Markdown"
-    )
+                # 7. Stream the Google Gemini Generative AI Model's answer into the chat
+                # The call runs on the worker pool; time spent queued counts towards the
+                # timeout, so a backed-up queue surfaces as a "System Error" reply
+                # instead of an ever-growing delay.
+                generate = partial(
+                    stream_reply,
+                    context.bot,
+                    chat_id,
+                    build_contents(history, contextual_prompt),
+                    progress,
+                )
+                # Identical prompts already in flight share that request's result
+                generated_text, is_leader = await single_flight(
+                    cache_key,
+                    lambda: asyncio.wait_for(submit_gemini_job(generate), timeout=GEMINI_TIMEOUT),
+                )
+
+                # 8. Validate the LLM output safely
+                if generated_text and len(generated_text.strip()) > 0:
+                    reply_text = generated_text
+                    answered = True
+                    # Followers of a merged request leave caching to the leader, and
+                    # truncated replies are never cached
+                    generated = is_leader and progress.complete
+                else:
+                    # Graceful fallback if the AI's mind goes blank
+                    reply_text = "I'm sorry, my AI engine couldn't process that\\. Could you try rephrasing?"
+
+            except errors.ClientError as e:
+                # 9. Handle API failures securely and categorize the error by its HTTP status
+                logger.error("Failed to generate AI response for User %s (%s): %s", user_id, user_name, e, exc_info=True)
+
+                # Check if the error is due to API quota limits or rate limiting
+                if e.code in _QUOTA_ERROR_CODES:
+                    reply_text = "⚠️ *API Limit Reached:* My AI engine is receiving too many requests right now or has reached its daily capacity\\. Please try again later or tomorrow\\!"
+
+                # Check if the error is due to an invalid or missing API key
+                elif is_invalid_api_key(e):
+                    reply_text = "🛑 *Configuration Error:* My API key seems to be invalid or expired\\. Please report this to the Developer\\!"
+
+                # Any other rejected request is reported like a generic failure
+                else:
+                    reply_text = "⚠️ *System Error:* My AI engine is currently unreachable or busy\\. Please try again in a moment\\!"
+
+            except Exception as e: 
+                # Fallback for any other unexpected system errors (e.g., server down, timeout)
+                logger.error("Failed to generate AI response for User %s (%s): %s", user_id, user_name, e, exc_info=True)
+                reply_text = "⚠️ *System Error:* My AI engine is currently unreachable or busy\\. Please try again in a moment\\!"
+
+        # 10. Transmit the final formulated text back to the user asynchronously
+        # Gemini's text is escaped and split to fit Telegram's limit; the canned notices
+        # above are already written in MarkdownV2. If the stream failed midway, the
+        # error notice replaces the partial preview instead of appearing beside it.
+        pieces = split_markdown_v2(reply_text, _TELEGRAM_MAX_CHARS) if answered else [reply_text]
+        await deliver_reply(context.bot, chat_id, pieces, progress)
+
+        # 11. Only once the reply was delivered, remember the exchange so the next message
+        # keeps its context, and cache fresh answers (fallbacks and errors are never kept)
+        if answered:
+            history.append(types.Content(role="user", parts=[types.Part(text=contextual_prompt)]))
+            history.append(types.Content(role="model", parts=[types.Part(text=reply_text)]))
+        if generated:
+            await cache_put(cache_key, reply_text)
+            if query_vector is not None:
+                await semantic_put(user_name, query_vector, reply_text)
 
 # ==========================================
 # GLOBAL ERROR HANDLING
@@ -146,34 +1496,117 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     """
     
     # 1. Log the critical error to the system console for debugging
-    logging.error(f"Exception while handling an update: {context.error}")
+    logger.error("Exception while handling an update: %s", context.error, exc_info=context.error)
 
     # 2. Construct the emergency notification payload
     error_message = (
-        f"🚨 **SYSTEM ALERT: BOT ENCOUNTERED AN ERROR!** 🚨\n\n"
-        f"**Error Details:**\n`{context.error}`"
+        f"🚨 *SYSTEM ALERT: BOT ENCOUNTERED AN ERROR\\!* 🚨\n\n"
+        f"*Error Details:*\n`{str(context.error).translate(_MDV2_CODE)}`"
     )
 
     # 3. Attempt to alert the developer via Telegram DM
     try:
-        # We use TELEGRAM_DEVELOPER_CHAT_ID defined from our .env variables globally
+        # We use TELEGRAM_DEVELOPER_CHAT_ID (bound to _DEV_CHAT) from our .env variables
         await context.bot.send_message(
-            chat_id=TELEGRAM_DEVELOPER_CHAT_ID, 
+            chat_id=_DEV_CHAT, 
             text=error_message, 
-            parse_mode="Markdown"
+            parse_mode="MarkdownV2"
         )
     except Exception as e:
         # If the bot fails to send the error message (e.g., developer blocked the bot), 
         # we log this failure and gracefully pass to prevent an infinite loop of crashes.
-        logging.error(f"Failed to deliver error alert to Developer: {e}")
+        logger.error("Failed to deliver error alert to Developer: %s", e)
         pass
 
+# ==========================================
+# APPLICATION LIFECYCLE HOOKS
+# ==========================================
+async def on_startup(application: Application) -> None:
+    """
+    Runs once after the bot is initialized and before it starts receiving updates.
+
+    Opens the persistent cache store, creates the Gemini context cache, starts the
+    background tasks that keep it alive and batch embeddings, and spawns the Gemini
+    worker pool.
+
+    Args:
+        application (telegram.ext.Application): The bot application being started.
+    """
+    global _context_cache_task, _embedding_task
+
+    # Every blocking call (SQLite, large similarity scans) goes through asyncio.to_thread;
+    # size its pool explicitly instead of relying on the CPU-count based default
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=_IO_THREADS, thread_name_prefix="bot-io")
+    )
+
+    if CACHE_DB_PATH:
+        try:
+            await asyncio.to_thread(_db_open, CACHE_DB_PATH, _CACHE_TTL, _SEMANTIC_MAX)
+            await semantic_load()
+        except sqlite3.Error as e:
+            logger.warning("Cache database %s unavailable, caching in memory only: %s", CACHE_DB_PATH, e)
+
+    if await context_cache_supported() and await create_context_cache():
+        _context_cache_task = asyncio.create_task(refresh_context_cache())
+    _embedding_task = asyncio.create_task(embedding_batcher())
+
+    for _ in range(GEMINI_CONCURRENCY):
+        _gemini_workers.append(asyncio.create_task(gemini_worker()))
+
+async def on_shutdown(application: Application) -> None:
+    """
+    Runs once when the bot is shutting down.
+
+    Stops the background tasks, deletes the context cache so it stops accruing storage
+    cost, and closes the persistent cache store.
+
+    Args:
+        application (telegram.ext.Application): The bot application being stopped.
+    """
+    if _context_cache_task is not None:
+        _context_cache_task.cancel()
+
+    if _embedding_task is not None:
+        _embedding_task.cancel()
+
+    for worker in _gemini_workers:
+        worker.cancel()
+    _gemini_workers.clear()
+
+    if _context_cache_name is not None:
+        try:
+            await client.aio.caches.delete(name=_context_cache_name)
+        except Exception as e:
+            logger.warning("Failed to delete Gemini context cache %s: %s", _context_cache_name, e)
+
+    if _db is not None:
+        with _db_lock:
+            _db.close()
+
 # ==========================================
 # MAIN APPLICATION EXECUTOR
 # ==========================================
 if __name__ == "__main__":
+    # 0. Run on uvloop when installed; the bot is I/O-bound, so a faster loop is a direct win
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     # 1. Initialize and build the Bot Application using the secure token
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # PTB handles one update at a time by default, which would make every chat wait for
+    # the slowest Gemini call; concurrent_updates lets handlers for different chats
+    # overlap (turns within one chat stay ordered by the per-chat lock).
+    # Bot API calls share one multiplexed HTTP/2 connection instead of a pool of
+    # HTTP/1.1 connections (long-polling getUpdates keeps its own HTTP/1.1 client)
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .http_version("2")
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # 2. Register standard Command Handlers (e.g., /start)
     app.add_handler(CommandHandler("start", start_command))
@@ -185,6 +1618,16 @@ if __name__ == "__main__":
     # 4. Register the Global Error Handler
     app.add_error_handler(error_handler)
 
-    # 5. Ignite the engine and start continuous polling
+    # 5. Ignite the engine: receive pushed updates via webhook when a domain is configured,
+    # otherwise fall back to continuous long polling (handy for local development)
     print("🚀 Gemini Q&A Telegram Bot is currently online and listening...")
-    app.run_polling()
\ No newline at end of file
+    if WEBHOOK_DOMAIN:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TELEGRAM_TOKEN,
+            webhook_url=f"https://{WEBHOOK_DOMAIN}/{TELEGRAM_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
\ No newline at end of file